@@ -4,12 +4,198 @@
 Behav Res 47, 147–161 (2015). 
 https://doi.org/10.3758/s13428-014-0472-0. """
 
-import scipy
-import statsmodels.api as sm
+import scipy.stats
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import repeat
+import math
+import multiprocessing
 import numpy as np
 from warnings import warn
+try:
+    import numba
+except ImportError:
+    numba = None
+try:
+    import cupy
+except ImportError:
+    cupy = None
 
-def ACT_I(observed, alpha=0.05, Rtype="ADJ", nrep=30000, seed=0):    
+#transfers to the GPU and kernel launches happen once per batch: below this number of simulated cells
+#per batch, they cost more than they save
+_GPU_MIN_BATCH_CELLS = 10**6
+#the familywise critical value is the largest residual of one of the replicates, and different tables
+#(e.g. the observed table and a permutation of it) can have mathematically equal residuals that only differ
+#by rounding: residuals within this relative tolerance of the critical value are treated as ties
+_TIE_RTOL = 1e-12
+
+@lru_cache(maxsize=128)
+def _ppf(q):
+    #critical values only depend on alpha: cache them across calls
+    return scipy.stats.norm.ppf(q)
+
+def _residual_max_array(sims, n, adjusted, z_residuals, xp=np):
+    """
+    Compute the residuals of a batch of simulated tables, and reduce them per replicate.
+    
+    The residuals are computed in double precision, with the same operations as those of the observed table:
+    the observed table is itself a possible replicate, and its largest residual must tie exactly with the
+    critical value when it is selected as such.
+    xp is the array module the computation runs with (numpy, or cupy for arrays on the GPU).
+    
+    Returns
+    ----------
+    tuple
+        (maxabs, exceed, finite) where maxabs is the maximum absolute residual of each replicate,
+        exceed the number of residuals of each replicate exceeding z_residuals in absolute value,
+        and finite a boolean mask of the valid replicates (i.e. without empty rows or columns).
+    """
+    nfil, ncolumn = sims.shape[1:]
+    sims = sims.astype(xp.float64)
+    sim_margin_row = sims.sum(axis=2, keepdims=True)
+    sim_margin_col = sims.sum(axis=1, keepdims=True)
+    sim_expected = sim_margin_row*sim_margin_col/n
+    #replicates with empty rows or columns yield non-finite residuals
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if adjusted:
+            sim_variances = (1-sim_margin_row/n)*(1-sim_margin_col/n)
+            sim_residuals = (sims-sim_expected)/xp.sqrt(sim_expected*sim_variances)
+        else:
+            sqrt_mc_variance = math.sqrt((ncolumn-1)*(nfil-1)/(ncolumn*nfil))
+            sim_residuals = (sims-sim_expected)/(xp.sqrt(sim_expected)*sqrt_mc_variance)
+    finite = xp.isfinite(sim_residuals.sum(axis=(1, 2)))
+    #the residuals are not needed afterwards: take their absolute value in place
+    abs_sim = xp.abs(sim_residuals, out=sim_residuals)
+    maxabs = abs_sim.max(axis=(1, 2))
+    exceed = xp.count_nonzero(abs_sim > z_residuals, axis=(1, 2))
+    return maxabs, exceed, finite
+
+def _residual_max_gpu(sims, n, adjusted, z_residuals):
+    #same computation as _residual_max_array, run with cupy on the GPU. Only the per-replicate
+    #reductions are copied back to the host.
+    maxabs, exceed, finite = _residual_max_array(cupy.asarray(sims), n, adjusted, z_residuals, xp=cupy)
+    return cupy.asnumpy(maxabs), cupy.asnumpy(exceed), cupy.asnumpy(finite)
+
+def _residual_max_loops(sims, n, adjusted, z_residuals):
+    #same computation as _residual_max_array, written as explicit loops so that numba can compile it
+    #without materializing the residuals. The operations are kept in the same order (and compiled without
+    #fastmath) so that the residuals are bitwise identical to those of the observed table.
+    size, nfil, ncolumn = sims.shape
+    sqrt_mc_variance = math.sqrt((ncolumn-1)*(nfil-1)/(ncolumn*nfil))
+    maxabs = np.zeros(size)
+    exceed = np.zeros(size, dtype=np.int64)
+    finite = np.ones(size, dtype=np.bool_)
+    for r in numba.prange(size):
+        margin_row = np.zeros(nfil)
+        margin_col = np.zeros(ncolumn)
+        for i in range(nfil):
+            for j in range(ncolumn):
+                margin_row[i] += sims[r, i, j]
+                margin_col[j] += sims[r, i, j]
+        if margin_row.min() == 0 or margin_col.min() == 0:
+            finite[r] = False
+            continue
+        current_max = 0.0
+        count = 0
+        for i in range(nfil):
+            for j in range(ncolumn):
+                expected = margin_row[i]*margin_col[j]/n
+                if adjusted:
+                    sd = np.sqrt(expected*((1-margin_row[i]/n)*(1-margin_col[j]/n)))
+                else:
+                    sd = np.sqrt(expected)*sqrt_mc_variance
+                residual = abs((sims[r, i, j]-expected)/sd)
+                if residual > current_max:
+                    current_max = residual
+                if residual > z_residuals:
+                    count += 1
+        maxabs[r] = current_max
+        exceed[r] = count
+    return maxabs, exceed, finite
+
+_residual_max_kernel = _residual_max_array
+if numba is not None:
+    _residual_max_kernel = numba.njit(parallel=True, cache=True)(_residual_max_loops)
+
+def _init_worker():
+    #the batches are already spread over processes: keep numba's kernel single-threaded in each of them,
+    #so that only one level of parallelism is active
+    if numba is not None:
+        numba.set_num_threads(1)
+
+def _simulate_batch(rng, n, probabilities, size, Rtype, z_residuals, device='cpu'):
+    """
+    Generate a batch of replicates under independence and reduce their residuals.
+    
+    The replicates are always drawn on the CPU, so that a given seed yields the same replicates whatever the device
+    their residuals are computed on.
+    
+    Returns
+    ----------
+    tuple
+        (maxabs, cell_exceed, finite) where maxabs is the maximum absolute residual of each replicate,
+        cell_exceed the number of residuals of the valid replicates exceeding z_residuals in absolute value,
+        and finite a boolean mask of the valid replicates (i.e. without empty rows or columns).
+    """
+    #ravel and reshape return views of the contiguous buffers: no copy per batch
+    nfil, ncolumn = probabilities.shape
+    sims = rng.multinomial(int(n), 
+                           probabilities.ravel(), 
+                           size=size).reshape(size, nfil, ncolumn)
+    kernel = _residual_max_gpu if device=='cuda' else _residual_max_kernel
+    maxabs, exceed, finite = kernel(sims, float(n), Rtype=='ADJ', z_residuals)
+    return maxabs, exceed[finite].sum(), finite
+
+@lru_cache(maxsize=32)
+def _maxabs_distribution(n, probabilities_bytes, nfil, ncolumn, nrep, Rtype, z_residuals, seed, batch, workers, device):
+    """
+    Generate the replicates of a table under independence, and reduce them to the distribution of their
+    maximum absolute residual.
+    
+    The result only depends on the arguments, which are all hashable, so it is cached: repeated calls on tables
+    with the same total, independence probabilities and shape (e.g. in simulation studies) skip the bootstrap.
+    
+    Returns
+    ----------
+    tuple
+        (maxabs, cell_exceed) where maxabs is the sorted, read-only array of the maximum absolute residual of
+        each valid replicate, and cell_exceed the number of residuals of the valid replicates exceeding z_residuals
+        in absolute value.
+    """
+    probabilities = np.frombuffer(probabilities_bytes).reshape(nfil, ncolumn)
+    #replicates are generated and reduced batch by batch, so that only the maximum absolute residual
+    #of each replicate is kept in memory
+    sizes = [min(batch, nrep-start) for start in range(0, nrep, batch)]
+    if workers == 1:
+        rng = np.random.default_rng(seed=seed)
+        batches = [_simulate_batch(rng, n, probabilities, size, Rtype, z_residuals, device) for size in sizes]
+    else:
+        #seed may be anything default_rng accepts (int, Generator...): spawn the streams from its seed sequence,
+        #which is only public as bit_generator.seed_seq from numpy 1.25
+        seed_seq = np.random.default_rng(seed).bit_generator._seed_seq
+        if isinstance(seed, np.random.SeedSequence):
+            #spawn from a copy: like with workers=1, the caller's seed sequence must not be modified. Generators and
+            #bit generators are stateful, and are advanced as with workers=1
+            seed_seq = np.random.SeedSequence(seed_seq.entropy, spawn_key=seed_seq.spawn_key, pool_size=seed_seq.pool_size,
+                                              n_children_spawned=seed_seq.n_children_spawned)
+        rngs = [np.random.default_rng(child) for child in seed_seq.spawn(len(sizes))]
+        #numba's threading layer is not fork-safe once initialized: start the workers with spawn
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker) as executor:
+            batches = list(executor.map(_simulate_batch, rngs, repeat(n), repeat(probabilities), sizes,
+                                        repeat(Rtype), repeat(z_residuals)))
+    maxabs = []
+    cell_exceed = 0
+    for maxabs_batch, cell_exceed_batch, finite_batch in batches:
+        maxabs.append(maxabs_batch[finite_batch])
+        cell_exceed += cell_exceed_batch
+    #no batch at all when nrep is 0
+    maxabs = np.concatenate(maxabs) if maxabs else np.empty(0)
+    maxabs.sort()
+    maxabs.flags.writeable = False
+    return maxabs, cell_exceed
+
+def ACT_I(observed, alpha=0.05, Rtype="ADJ", nrep=30000, seed=0, batch=1024, workers=1, device='cpu'):    
     """
     Testing a contingency table and its residuals for independence.
     
@@ -25,6 +211,21 @@ def ACT_I(observed, alpha=0.05, Rtype="ADJ", nrep=30000, seed=0):
         Number of replicates to generate in the bootstrap procedure. Must be > 0. nrep >= 30000 is recommended.
     seed: int, default 0
         seed passed to the numpy random generator used to generate simulated tables. Allows replicating the results.
+    batch: int, default 1024
+        Number of replicates generated and processed at once. Peak memory use grows with batch, not with nrep.
+    workers: int, default 1
+        Number of processes the batches of replicates are distributed over. With workers > 1, each batch is
+        drawn from its own random stream spawned from 'seed', so the results are reproducible for a given seed and batch
+        whatever the number of workers, but differ from those obtained with workers=1. The worker processes are started
+        with the 'spawn' method, so scripts calling ACT_I with workers > 1 must do so under if __name__ == "__main__":.
+        A new pool of processes is started on every call, and each of them imports numpy, scipy (and numba) again,
+        which costs a few seconds. When numba is installed, workers=1 already runs the replicates on all cores, so
+        workers > 1 only pays off when numba is missing or nrep is very large (millions of replicates).
+    device: str, default 'cpu'
+        One of 'cpu' or 'cuda'. With 'cuda', the residuals of the replicates are computed on the GPU with cupy, which must
+        be installed. The GPU is only used when nrep * number of cells reaches 1 million, and batch is then raised so
+        that each batch holds at least 1 million cells. Cannot be combined with workers > 1. This path has not been
+        tested on a GPU yet.
         
     Returns
     ----------
@@ -45,7 +246,7 @@ def ACT_I(observed, alpha=0.05, Rtype="ADJ", nrep=30000, seed=0):
             - ExpectedFrequencies: numpy.array
                 Expected cell frequencies under independence.
             - Residuals: numpy.array
-                Cell residuals. Use statsmodels adjusted residuals when Rtype is 'ADJ' (statsmodels.stats.contingency_tables.Table.standardized_resids)
+                Cell residuals: adjusted residuals (O-E)/sqrt(E*(1-row/n)*(1-col/n)) when Rtype is 'ADJ', moment-corrected residuals when Rtype is 'MC'
             - Cellwise_CriticalValue: float
                 Critical value used in cellwise significance tests of residuals.
             - Cellwise_Significant: numpy array
@@ -73,11 +274,15 @@ def ACT_I(observed, alpha=0.05, Rtype="ADJ", nrep=30000, seed=0):
     #check the input table for possible errors
     if isinstance(observed, np.ndarray) == False:
         raise  TypeError("'observed' must be a numpy array")
-    if len(observed.shape) > 2 or np.size(observed) < 4:
+    size = observed.size
+    if len(observed.shape) > 2 or size < 4:
         raise  ValueError("The contingency table is not a two-way table")
     if np.isnan(observed).any():
         raise ValueError("The contingency table cannot contain missing values")
-    if 0 in observed.sum(axis=0) or 0 in observed.sum(axis=1):
+    #sum in double precision: products of integer margins may overflow (e.g. int32, the default integer on Windows)
+    margin_col = observed.sum(axis=0, dtype=np.float64)
+    margin_row = observed.sum(axis=1, dtype=np.float64).reshape(-1,1)
+    if not (margin_col.all() and margin_row.all()):
         raise ValueError("The table cannot have empty rows or columns")
     #check the other parameters
     if Rtype.lower() not in ["adj", "mc"]:
@@ -89,73 +294,78 @@ def ACT_I(observed, alpha=0.05, Rtype="ADJ", nrep=30000, seed=0):
         nrep = int(nrep)
     elif isinstance(nrep, int) == False or nrep < 0:
         raise  ValueError("nrep must be a positive integer")
+    if isinstance(batch, int) == False or batch <= 0:
+        raise  ValueError("batch must be a positive integer")
+    if isinstance(workers, int) == False or workers <= 0:
+        raise  ValueError("workers must be a positive integer")
+    if device not in ["cpu", "cuda"]:
+        raise  ValueError("device must be 'cpu' or 'cuda'")
+    if device == "cuda":
+        if cupy is None:
+            raise ImportError("device='cuda' requires cupy")
+        if workers > 1:
+            raise  ValueError("device='cuda' cannot be combined with workers > 1")
+        if nrep * size < _GPU_MIN_BATCH_CELLS:
+            device = "cpu"
+        else:
+            #the replicates are drawn from a single stream with workers=1: the batch size does not change them
+            batch = max(batch, math.ceil(_GPU_MIN_BATCH_CELLS/size))
     
     #warnings
     if nrep < 30000:
         warn("Consider using at least 30,000 replicates", stacklevel=2)
         
-    if (np.product(observed.shape) * nrep) <1000:
-        warn("consider increasing the number of replicates to at least "+str(round((1000/np.product(observed.shape))+1, 0)) + " to get enough valid replicates",
+    if (size * nrep) <1000:
+        warn("consider increasing the number of replicates to at least "+str(round((1000/size)+1, 0)) + " to get enough valid replicates",
              stacklevel=2)
     nfil, ncolumn = observed.shape
-    margin_col = observed.sum(axis=0)
-    margin_row = observed.sum(axis=1).reshape(-1,1)
-    n = observed.sum()
-    table = sm.stats.Table(observed)
-    expected = table.fittedvalues
-    probabilities = table.independence_probabilities # expected/n
+    n = margin_col.sum()
+    expected = margin_row*margin_col/n
+    probabilities = expected/n
     if Rtype=='ADJ':
         variances = (1-margin_row/n)*(1-margin_col/n)
-        residuals = table.standardized_resids
+        residuals = (observed-expected)/np.sqrt(expected*variances)
     else:
-        variances = np.zeros(shape=observed.shape)
-        variances.fill( (ncolumn-1)*(nfil-1)/(ncolumn*nfil) )
-        residuals = (observed-expected)/np.sqrt(expected*variances) 
-    rng = np.random.default_rng(seed=seed)
-    simulations = rng.multinomial(n, 
-                            probabilities.flatten(), 
-                            size=nrep)
-    
-    simulations = [ sim.reshape(observed.shape) for sim in simulations]
-    sim_expected = [np.zeros(shape=observed.shape) for i in range(nrep)]
-    sim_variances = [np.zeros(shape=observed.shape) for i in range(nrep)]
-    sim_residuals = [np.zeros(shape=observed.shape) for i in range(nrep)]
-    for index, sim in enumerate(simulations):
-        sim_table = sm.stats.Table(sim)
-        sim_expected[index]  = sim_table.fittedvalues
-        if Rtype=='ADJ':
-            sim_margin_col = sim.sum(axis=0)
-            sim_margin_row = sim.sum(axis=1).reshape(-1,1)
-            sim_variances[index] = (1-sim_margin_row/n)*(1-sim_margin_col/n)
-            sim_residuals[index] = sim_table.standardized_resids
-        else:
-            sim_variances[index].fill( (ncolumn-1)*(nfil-1)/(ncolumn*nfil) )
-            sim_residuals[index] = (sim-sim_expected[index])/np.sqrt(sim_expected[index]*sim_variances[index]) 
-    toKeep = np.isfinite([r.sum() for r in sim_residuals])
-    valid = len(toKeep)
+        residuals = (observed-expected)/(np.sqrt(expected)*math.sqrt((ncolumn-1)*(nfil-1)/(ncolumn*nfil)))
+    #a replicate is invalid when one of its rows or columns is empty. Each row (column) is empty with
+    #probability (1-share)^n; if nearly all replicates would be invalid, fail before generating them
+    shares = np.concatenate([margin_row.ravel(), margin_col])/n
+    p_invalid = 1-np.prod(1-np.exp(n*np.log1p(-shares)))
+    if p_invalid > 0.9:
+        raise ValueError('Table is too sparse to produce valid replicates; consider merging rows or columns')
+    zmin = _ppf(1-alpha) 
+    zmax = 10
+    z_residuals = _ppf(1-alpha/2)
+    #the cached helper reads the probabilities back as float64, whatever the dtype of the input table
+    probabilities_bytes = np.ascontiguousarray(probabilities, dtype=np.float64).tobytes()
+    args = (n, probabilities_bytes, nfil, ncolumn, nrep, Rtype, z_residuals, seed, batch, workers, device)
+    if isinstance(seed, (int, np.integer)):
+        maxabs, cell_exceed = _maxabs_distribution(*args)
+    else:
+        #without an integer seed, every call must draw new replicates
+        maxabs, cell_exceed = _maxabs_distribution.__wrapped__(*args)
+    valid = maxabs.size
     if valid==0 :
         raise ValueError('Table is too sparse to produce valid replicates; consider merging rows or columns')
     elif valid <= nrep/2:
         warn('Table seems to be too sparse; consider merging rows or columns')    
-    sim_residuals = [s for i, s in enumerate(sim_residuals) if toKeep[i] == True]
-    total = np.size(sim_residuals)    
-    zmin = scipy.stats.norm.ppf(1-alpha) 
-    zmax = 10
-    z_residuals = scipy.stats.norm.ppf(1-alpha/2)
-    signif_residual =(abs(residuals)>z_residuals)
+    total = valid * nfil * ncolumn
+    abs_residuals = np.abs(residuals)
+    signif_residual =(abs_residuals>z_residuals)
     #check if there are enough valid replicates
     if total > 1000:
-        for i in range(25):
-            z_omnibus = (zmax+zmin)/2
-            type1 = np.mean([True in (abs(sim) > z_omnibus) for sim in sim_residuals])
-            if type1>alpha:
-                zmin = z_omnibus
-            else:
-                zmax = z_omnibus
+        #the familywise critical value is the smallest z such that at most a proportion alpha
+        #of the replicates have a residual exceeding z, i.e. the (1-alpha) quantile of the
+        #replicates' maximum absolute residual, kept within the [zmin, zmax] search range.
+        #maxabs being sorted, this quantile is a plain order statistic, and the proportion of replicates
+        #exceeding any z is found by binary search
+        z_omnibus = float(np.clip(maxabs[max(math.ceil(valid*(1-alpha))-1, 0)], zmin, zmax))
+        z_tie = z_omnibus*(1+_TIE_RTOL)
+        type1 = (valid-np.searchsorted(maxabs, z_tie, side='right'))/valid
         
-        type1_cell = np.mean(np.absolute(sim_residuals)>z_residuals)        
+        type1_cell = cell_exceed / total        
         alpha_star = 2*scipy.stats.norm.cdf(-z_omnibus)    
-        signif_omnibus = (abs(residuals)>z_omnibus)
+        signif_omnibus = (abs_residuals>z_tie)
         
         if signif_omnibus.any():
             omnibus_test = 'Rejected'
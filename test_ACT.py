@@ -0,0 +1,115 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+import numpy as np
+import pytest
+
+import ACT
+from ACT import ACT_I
+
+OBSERVED = np.array([[ 1 , 7, 15, 12, 12, 14],
+                     [ 1, 16, 22, 31, 32, 27],
+                     [ 7, 14, 25, 28, 46, 44],
+                     [13, 19, 34, 45, 63, 72]])
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.int32, np.float64])
+def test_non_float64_input(dtype):
+    expected = ACT_I(OBSERVED.astype(np.float64), nrep=30000)
+    result = ACT_I(OBSERVED.astype(dtype), nrep=30000)
+    assert result["ValidReplicates"] == expected["ValidReplicates"]
+    assert result["Famwise_CriticalValue"] == pytest.approx(expected["Famwise_CriticalValue"], rel=1e-5)
+
+
+def test_workers_after_single_process_run_exits():
+    # a parallel numba kernel run in the parent must not leave the worker pool hanging at exit
+    script = textwrap.dedent("""
+        import warnings
+        import numpy as np
+        from ACT import ACT_I
+        if __name__ == "__main__":
+            warnings.simplefilter("ignore")
+            observed = np.array(%r)
+            ACT_I(observed, nrep=5000, workers=1)
+            ACT_I(observed, nrep=5000, workers=2)
+    """ % OBSERVED.tolist())
+    subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(os.path.abspath(__file__)), check=True, timeout=120)
+
+
+@pytest.mark.parametrize("seed", [np.random.default_rng(0), np.random.PCG64(0), np.random.SeedSequence(0)])
+def test_workers_with_generator_seed(seed):
+    result = ACT_I(OBSERVED, nrep=30000, seed=seed, workers=2)
+    assert result["ValidReplicates"] == 30000
+
+
+def test_workers_integer_seed_matches_seed_sequence():
+    # an integer seed spawns the same streams as np.random.SeedSequence(seed)
+    first = ACT_I(OBSERVED, nrep=30000, seed=0, workers=2, batch=5000)
+    second = ACT_I(OBSERVED, nrep=30000, seed=np.random.SeedSequence(0), workers=2, batch=5000)
+    assert first["Famwise_CriticalValue"] == second["Famwise_CriticalValue"]
+
+
+@pytest.mark.parametrize("observed", [[[4, 0], [0, 1]],
+                                      [[1, 3], [3, 0], [2, 0]],
+                                      [[2, 2, 3], [4, 0, 0], [2, 2, 4]]])
+def test_observed_residual_tying_critical_value_is_not_significant(observed):
+    # the observed table is itself a possible replicate: a residual equal to the critical value is a tie
+    result = ACT_I(np.array(observed), nrep=5000)
+    assert np.abs(result["Residuals"]).max() == pytest.approx(result["Famwise_CriticalValue"], rel=1e-12)
+    assert result["OmnibusHypothesis"] == "Not rejected"
+
+
+def test_large_int32_margins_do_not_overflow():
+    observed = np.array([[60000, 50000], [40000, 70000]], dtype=np.int32)
+    result = ACT_I(observed, nrep=2000)
+    expected = observed.sum(axis=1, dtype=np.float64)[:, None]*observed.sum(axis=0, dtype=np.float64)/observed.sum(dtype=np.float64)
+    np.testing.assert_allclose(result["ExpectedFrequencies"], expected)
+
+
+def test_workers_do_not_modify_seed_sequence():
+    seed = np.random.SeedSequence(0)
+    first = ACT_I(OBSERVED, nrep=30000, seed=seed, workers=2)
+    second = ACT_I(OBSERVED, nrep=30000, seed=seed, workers=2)
+    assert seed.n_children_spawned == 0
+    assert first["Famwise_CriticalValue"] == second["Famwise_CriticalValue"]
+
+
+@pytest.mark.parametrize("adjusted", [True, False])
+@pytest.mark.parametrize("observed", [OBSERVED, np.array([[1, 0, 3], [2, 1, 0], [0, 1, 1]])], ids=["dense", "sparse"])
+def test_numba_kernel_matches_numpy_kernel(observed, adjusted):
+    pytest.importorskip("numba")
+    n = observed.sum()
+    probabilities = observed.sum(axis=1, keepdims=True)*observed.sum(axis=0)/n/n
+    sims = np.random.default_rng(0).multinomial(n, probabilities.ravel(), size=2000).reshape(2000, *observed.shape)
+    maxabs, exceed, finite = ACT._residual_max_array(sims, float(n), adjusted, 1.96)
+    maxabs_jit, exceed_jit, finite_jit = ACT._residual_max_kernel(sims, float(n), adjusted, 1.96)
+    assert finite.any()
+    np.testing.assert_array_equal(finite_jit, finite)
+    np.testing.assert_allclose(maxabs_jit[finite], maxabs[finite], rtol=1e-12)
+    np.testing.assert_array_equal(exceed_jit[finite], exceed[finite])
+
+
+def test_valid_replicates_excludes_replicates_with_empty_margins():
+    result = ACT_I(np.array([[1, 0, 3], [2, 1, 0], [0, 1, 1]]), nrep=3000)
+    assert result["ValidReplicates"] == 2287
+
+
+def test_too_sparse_table_raises_before_sampling(monkeypatch):
+    # about 97% of the replicates of this table would have an empty row or column
+    def fail(*args, **kwargs):
+        raise AssertionError("replicates should not be generated")
+    monkeypatch.setattr(ACT, "_simulate_batch", fail)
+    observed = np.array([[1, 0, 0, 0, 0], [0, 1, 0, 0, 0], [0, 0, 1, 0, 0],
+                         [0, 0, 0, 1, 0], [0, 0, 0, 0, 1], [0, 0, 0, 1, 1]])
+    with pytest.raises(ValueError, match="too sparse"):
+        ACT_I(observed)
+
+
+def test_borderline_sparse_table_still_returns_results():
+    # about 74% of the replicates of this table have an empty row or column: below the early failure threshold
+    with pytest.warns(UserWarning, match="too sparse"):
+        result = ACT_I(np.array([[1, 0, 0], [0, 1, 0], [0, 0, 1], [5, 5, 5]]), nrep=30000)
+    assert result["ValidReplicates"] == 7400
+    assert result["OmnibusHypothesis"] == "Not rejected"